@@ -1,10 +1,17 @@
 import asyncio
+import concurrent.futures
 import logging
+import math
+from contextlib import asynccontextmanager
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import Command
 import aiosqlite
+import numpy as np
 import yfinance as yf
 import os
+import sys
+import threading
+import time
 
 # Токен из BotFather
 TOKEN = os.getenv("BOT_TOKEN")
@@ -18,123 +25,267 @@ logging.basicConfig(level=logging.INFO)
 bot = Bot(token=TOKEN)
 dp = Dispatcher()
 
-# Запуск
-async def main():
-    await dp.start_polling(bot)
+# Постоянные тексты ответов
+_START_MSG = ("Привет! Я помогу отслеживать твой инвестицонный портфель. \n"
+              "Команды: \n"
+              "/add TICKER КОЛИЧЕСТВО ЦЕНА ПОКУПКИ - добавить сделку\n"
+              "/portfolio - показать текущий портфель\n"
+              "/help - справка")
+_HELP_MSG = ("Команды:\n"
+             "/add TICKER КОЛИЧЕСТВО ЦЕНА — добавить сделку\n"
+             "/portfolio — показать портфель")
+_ADD_USAGE = "Формат: /add TICKER КОЛИЧЕСТВО ЦЕНА_ПОКУПКИ\nНапример: /add AAPL 10 150"
+
+# Кэш последних цен закрытия (ticker -> (цена, срок годности))
+PRICE_TTL = 60
+PRICE_CACHE_MAX = 4096
+_price_cache: dict[str, tuple[float, float]] = {}
+# Загрузки, которые уже идут: параллельные /portfolio ждут их, а не запрашивают заново
+_price_inflight: dict[str, asyncio.Task] = {}
+# Отдельный пул потоков для yfinance, чтобы не занимать пул по умолчанию
+_YF_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="yfinance")
+# yf.download хранит результаты в глобальном yfinance.shared, поэтому вызовы идут по одному
+_YF_DOWNLOAD_LOCK = threading.Lock()
+
+
+def _download_prices_sync(symbols: list[str]) -> dict[str, float]:
+    # yf.download делает по запросу на тикер; threads>1 выполняет их параллельно
+    with _YF_DOWNLOAD_LOCK:
+        df = yf.download(" ".join(symbols), period="1d", progress=False,
+                         group_by="ticker", threads=min(len(symbols), 8),
+                         multi_level_index=True)
+    # Тикеры без цены не попадают в результат и поэтому не кэшируются
+    prices = {}
+    for sym in symbols:
+        try:
+            close = df[sym]['Close'].dropna()
+        except KeyError:
+            continue
+        if not close.empty:
+            prices[sym] = float(close.iloc[-1])
+    return prices
+
+
+async def _fetch_prices(symbols: list[str]) -> dict[str, float]:
+    try:
+        fetched = await asyncio.get_running_loop().run_in_executor(
+            _YF_POOL, _download_prices_sync, symbols)
+    except Exception as e:
+        logging.error(f"Ошибка получения цен для {', '.join(symbols)}: {e}")
+        return dict.fromkeys(symbols, 0.0)
+    finally:
+        task = asyncio.current_task()
+        for sym in symbols:
+            if _price_inflight.get(sym) is task:
+                del _price_inflight[sym]
+
+    expiry = time.monotonic() + PRICE_TTL
+    for sym, price in fetched.items():
+        # Переставляем тикер в конец, чтобы в начале словаря были самые старые записи
+        _price_cache.pop(sym, None)
+        _price_cache[sym] = (price, expiry)
+    while len(_price_cache) > PRICE_CACHE_MAX:
+        del _price_cache[next(iter(_price_cache))]
+    return fetched
+
+
+async def get_prices(symbols: list[str]) -> dict[str, float]:
+    now = time.monotonic()
+    prices = {}
+    waiting: dict[str, asyncio.Task] = {}
+    missing = []
+    for sym in dict.fromkeys(symbols):
+        cached = _price_cache.get(sym)
+        if cached is not None and cached[1] > now:
+            prices[sym] = cached[0]
+        elif sym in _price_inflight:
+            waiting[sym] = _price_inflight[sym]
+        else:
+            missing.append(sym)
+
+    if missing:
+        task = asyncio.create_task(_fetch_prices(missing))
+        for sym in missing:
+            _price_inflight[sym] = waiting[sym] = task
+
+    # shield: отмена одного обработчика не должна отменять общую загрузку
+    for task in set(waiting.values()):
+        await asyncio.shield(task)
+    for sym, task in waiting.items():
+        prices[sym] = task.result().get(sym, 0.0)
+    return prices
+
+
+DB_PATH = 'investments.db'
+PRAGMAS = '''
+    PRAGMA journal_mode=WAL;
+    PRAGMA temp_store=memory;
+    PRAGMA synchronous=normal;
+    PRAGMA cache_size=-64000;
+'''
+
+
+class AioSqlitePool:
+    """Один пишущий и несколько читающих соединений с SQLite (WAL)."""
 
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.readers = readers
+        self._read_queue: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._writer: aiosqlite.Connection | None = None
+        self._write_lock = asyncio.Lock()
+        # Все открытые соединения, включая выданные в acquire_read()
+        self._connections: list[aiosqlite.Connection] = []
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.path)
+        self._connections.append(conn)
+        await conn.executescript(PRAGMAS)
+        return conn
+
+    async def open(self):
+        # Писатель открывается первым, чтобы WAL включился до читателей
+        self._writer = await self._connect()
+        for _ in range(self.readers):
+            self._read_queue.put_nowait(await self._connect())
+
+    async def close(self):
+        while not self._read_queue.empty():
+            self._read_queue.get_nowait()
+        connections, self._connections = self._connections, []
+        self._writer = None
+        for conn in connections:
+            await conn.close()
+
+    @asynccontextmanager
+    async def acquire_read(self):
+        conn = await self._read_queue.get()
+        try:
+            yield conn
+        finally:
+            self._read_queue.put_nowait(conn)
+
+    @asynccontextmanager
+    async def acquire_write(self):
+        async with self._write_lock:
+            yield self._writer
+
+
+pool = AioSqlitePool(DB_PATH)
 
 
 async def init_db():
-    async with aiosqlite.connect('investments.db') as db:
+    await pool.open()
+    async with pool.acquire_write() as db:
         await db.execute(' CREATE TABLE IF NOT EXISTS holdings (user_id INTEGER, ticker TEXT, quantity REAL, buy_price REAL, PRIMARY KEY (user_id, ticker))')
         await db.commit()
 
 
-
 # --- Обработчики команд (какие ты уже написал) ---
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
-    await message.answer("Привет! Я помогу отслеживать твой инвестицонный портфель. \n"
-                         "Команды: \n"
-                         "/add TICKER КОЛИЧЕСТВО ЦЕНА ПОКУПКИ - добавить сделку\n"
-                         "/portfolio - показать текущий портфель\n"
-                         "/help - справка")
+    await message.answer(_START_MSG)
 
 
 # ... остальные команды ...
 # В функции main перед dp.start_polling:
 # --- Главная функция ---
 async def main():
-    await init_db()          # <-- Вот здесь вызываем инициализацию
-    await dp.start_polling(bot)
+    try:
+        await init_db()          # <-- Вот здесь вызываем инициализацию
+        await dp.start_polling(bot)
+    finally:
+        # Закрываем ресурсы и при ошибке, и при обычной остановке.
+        # Сессию бота закрывает сам start_polling (close_bot_session=True)
+        _YF_POOL.shutdown(wait=False, cancel_futures=True)
+        await pool.close()
 
 
 @dp.message(Command("add"))
 async def cmd_add(message: types.Message):
-    args = message.text.split()
+    # maxsplit=4 ограничивает разбор, но лишний аргумент всё равно даёт len(args) != 4
+    args = message.text.split(maxsplit=4)
     if len(args) != 4:
-        await message.answer("Формат: /add TICKER КОЛИЧЕСТВО ЦЕНА_ПОКУПКИ\nНапример: /add AAPL 10 150")
+        await message.answer(_ADD_USAGE)
         return
 
     _, ticker, qty_str, price_str = args
+    ticker = ticker.upper()
     try:
         qty = float(qty_str)
         price = float(price_str)
+        # inf и nan проходят float(), но портят итоги портфеля
+        if not (math.isfinite(qty) and math.isfinite(price)):
+            raise ValueError
     except ValueError:
         await message.answer("Количество и цена должны быть числами")
         return
 
     user_id = message.from_user.id
-    async with aiosqlite.connect('investments.db') as db:
+    async with pool.acquire_write() as db:
         # Используем INSERT OR REPLACE, чтобы обновить, если уже есть такая позиция
         await db.execute('''
             INSERT OR REPLACE INTO holdings (user_id, ticker, quantity, buy_price)
             VALUES (?, ?, ?, ?)
-        ''', (user_id, ticker.upper(), qty, price))
+        ''', (user_id, ticker, qty, price))
         await db.commit()
 
-    await message.answer(f"Добавлено: {ticker.upper()} {qty} шт. по цене {price}")
+    await message.answer(f"Добавлено: {ticker} {qty} шт. по цене {price}")
 
-    @dp.message(Command("portfolio"))
-    async def cmd_portfolio(message: types.Message):
-        user_id = message.from_user.id
-        async with aiosqlite.connect('investments.db') as db:
-            cursor = await db.execute(
-                "SELECT ticker, quantity, buy_price FROM holdings WHERE user_id=?",
-                (user_id,)
-            )
+@dp.message(Command("portfolio"))
+async def cmd_portfolio(message: types.Message):
+    user_id = message.from_user.id
+    async with pool.acquire_read() as db:
+        async with db.execute(
+            "SELECT ticker, quantity, buy_price FROM holdings WHERE user_id=?",
+            (user_id,)
+        ) as cursor:
             rows = await cursor.fetchall()
 
-        if not rows:
-            await message.answer("Портфель пуст. Добавьте бумаги через /add")
-            return
-
-        total_cost = 0.0
-        total_value = 0.0
-        lines = []
-
-        for ticker, qty, buy_price in rows:
-            try:
-                stock = yf.Ticker(ticker)
-                # Берём последнюю цену закрытия
-                hist = stock.history(period="1d")
-                if hist.empty:
-                    current_price = 0.0
-                else:
-                    current_price = hist['Close'].iloc[-1]
-            except Exception as e:
-                current_price = 0.0
-                logging.error(f"Ошибка получения цены для {ticker}: {e}")
-
-            cost = qty * buy_price
-            value = qty * current_price
-            profit = value - cost
-            profit_pct = (profit / cost * 100) if cost != 0 else 0
-
-            lines.append(
-                f"{ticker}: {qty} шт.\n"
-                f"  покупка: {buy_price:.2f} | сейчас: {current_price:.2f}\n"
-                f"  стоимость: {value:.2f} | прибыль: {profit:.2f} ({profit_pct:.1f}%)"
-            )
-
-            total_cost += cost
-            total_value += value
-
-        total_profit = total_value - total_cost
-        total_profit_pct = (total_profit / total_cost * 100) if total_cost != 0 else 0
-
-        header = f"Общая стоимость: {total_value:.2f}\n"
-        header += f"Общая прибыль: {total_profit:.2f} ({total_profit_pct:.1f}%)\n\n"
-        await message.answer(header + "\n".join(lines))
+    if not rows:
+        await message.answer("Портфель пуст. Добавьте бумаги через /add")
+        return
+
+    # Цены всех бумаг; повторяющиеся тикеры get_prices() запрашивает один раз
+    price_map = await get_prices([row[0] for row in rows])
+    qty = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+    buy = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+    cur = np.fromiter((price_map[row[0]] for row in rows), dtype=np.float64, count=len(rows))
+
+    cost = qty * buy
+    value = qty * cur
+    profit = value - cost
+    pct = np.divide(profit * 100, cost, out=np.zeros_like(profit), where=cost != 0)
+    total_cost = float(cost.sum())
+    total_value = float(value.sum())
+
+    lines = [
+        f"{ticker}: {q} шт.\n"
+        f"  покупка: {bp:.2f} | сейчас: {c:.2f}\n"
+        f"  стоимость: {v:.2f} | прибыль: {p:.2f} ({pc:.1f}%)"
+        for (ticker, q, bp), c, v, p, pc
+        in zip(rows, cur.tolist(), value.tolist(), profit.tolist(), pct.tolist())
+    ]
+
+    total_profit = total_value - total_cost
+    total_profit_pct = (total_profit / total_cost * 100) if total_cost != 0 else 0
+
+    parts = [
+        f"Общая стоимость: {total_value:.2f}",
+        f"Общая прибыль: {total_profit:.2f} ({total_profit_pct:.1f}%)",
+        "",
+    ]
+    parts.extend(lines)
+    await message.answer("\n".join(parts))
 
 @dp.message(Command("help"))
 async def cmd_help(message: types.Message):
-    await message.answer(
-        "Команды:\n"
-        "/add TICKER КОЛИЧЕСТВО ЦЕНА — добавить сделку\n"
-        "/portfolio — показать портфель"
-    )
+    await message.answer(_HELP_MSG)
 
 # --- Запуск ---
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if sys.platform != "win32":
+        import uvloop
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
\ No newline at end of file